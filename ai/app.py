@@ -4,26 +4,38 @@ AI Detection Service with WebRTC Video Track support
 - WebRTC endpoint for real-time video streaming with server-side rendering (aiortc)
 """
 
+import os
 import json
+import queue
 import asyncio
 import logging
+import threading
+import fractions
+from functools import lru_cache
 from pathlib import Path
 from typing import List
 from time import perf_counter
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import cv2
 import numpy as np
+import orjson
 import torch
 from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from ultralytics import YOLO
+from ultralytics.engine.results import Boxes
+from ultralytics.trackers.byte_tracker import BYTETracker
+from ultralytics.utils import IterableSimpleNamespace, ops, yaml_load
+from ultralytics.utils.checks import check_yaml
 
 # aiortc imports for WebRTC
 from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack, RTCRtpSender
+from aiortc.codecs import h264 as aiortc_h264
 from aiortc.contrib.media import MediaRelay
+import av
 from av import VideoFrame
 
 # Configure logging
@@ -41,9 +53,78 @@ except Exception:
 DEFAULT_MODEL = Path(__file__).parent / "models" / "best.pt"
 MODEL_PATH = DEFAULT_MODEL
 MODEL_NAME = MODEL_PATH.name
+MODEL_NAMES = {}  # class id -> name, cached at startup
 model = None
 READY = False
 
+# Frames from all live WebRTC tracks are batched into one forward pass
+INFER_BATCH = max(1, int(os.getenv("INFER_BATCH", "4")))
+BATCH_WAIT_MS = float(os.getenv("BATCH_WAIT_MS", "5"))
+
+# TensorRT engine (GPU only) - exported once next to the .pt and reused on later starts
+INFER_IMGSZ = 640  # Fixed input size; the engine is built for exactly this shape
+DETECT_IMGSZ = 832  # /v1/detect default imgsz (PyTorch weights only)
+USE_TENSORRT = os.getenv("USE_TENSORRT", "1") == "1"
+# "int8" needs a calibration dataset yaml in CALIB_DATA and INT8 tensor cores (Turing+);
+# otherwise the FP16 engine is used
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "fp16").lower()
+CALIB_DATA = os.getenv("CALIB_DATA", "")
+INT8_MIN_CAPABILITY = (7, 5)
+
+# PyTorch weights on GPU: torch.compile(mode="reduce-overhead") the batched forward so
+# each fixed-shape batch replays as one CUDA graph (engines are already graph-optimized)
+USE_TORCH_COMPILE = os.getenv("USE_TORCH_COMPILE", "1") == "1"
+COMPILE_MIN_CAPABILITY = (7, 0)
+USING_ENGINE = False
+
+# Real class count when the head was trained with dummy classes so its output
+# channels are a multiple of 8 (Tensor Core friendly); 0 keeps every class
+NUM_CLASSES = int(os.getenv("NUM_CLASSES", "0"))
+
+# ByteTracker settings (bundled with ultralytics); each video track owns its own tracker
+TRACKER_CFG = IterableSimpleNamespace(**yaml_load(check_yaml("bytetrack.yaml")))
+
+
+def export_engine(int8: bool = False) -> Path:
+    """Export (once) and return the TensorRT engine for the requested precision."""
+    suffix = "_int8" if int8 else ""
+    engine_path = MODEL_PATH.with_name(f"{MODEL_PATH.stem}{suffix}_b{INFER_BATCH}.engine")
+    if engine_path.exists():
+        return engine_path
+
+    logger.info(f"Exporting TensorRT {'INT8' if int8 else 'FP16'} engine to {engine_path} (one-time)")
+    precision = {"int8": True, "data": CALIB_DATA} if int8 else {"half": True}
+    exported = YOLO(MODEL_PATH).export(
+        format="engine",
+        imgsz=INFER_IMGSZ,
+        dynamic=INFER_BATCH > 1,  # batch dim must be dynamic to run 1..INFER_BATCH frames
+        batch=INFER_BATCH,
+        workspace=4,
+        device=0,
+        **precision,
+    )
+    if Path(exported) != engine_path:
+        Path(exported).rename(engine_path)
+    return engine_path
+
+
+def resolve_model_path() -> Path:
+    """Return the weights to load: a TensorRT engine on GPU, else the raw .pt."""
+    if not (USE_TENSORRT and torch.cuda.is_available()):
+        return MODEL_PATH
+    if MODEL_PRECISION == "int8":
+        capability = torch.cuda.get_device_capability(0)
+        if not CALIB_DATA:
+            logger.warning("MODEL_PRECISION=int8 needs CALIB_DATA; using the FP16 engine")
+        elif capability < INT8_MIN_CAPABILITY:
+            logger.warning(f"GPU compute capability {capability} has no INT8 tensor cores; using the FP16 engine")
+        else:
+            try:
+                return export_engine(int8=True)
+            except Exception as e:
+                logger.warning(f"INT8 export failed, falling back to FP16 engine: {e}")
+    return export_engine()
+
 # ==================== Pydantic Models ====================
 
 class Detection(BaseModel):
@@ -79,6 +160,379 @@ app.add_middleware(
 pcs = set()  # Active peer connections
 relay = MediaRelay()
 
+# Upscale outgoing frames below this height before encoding (0 = off, e.g. 720).
+# The browser scales the video element itself, so this only costs CPU by default.
+UPSCALE_MIN_HEIGHT = int(os.getenv("UPSCALE_MIN_HEIGHT", "0"))
+
+# DataChannel timestamps are naive UTC datetimes, serialized as RFC 3339 with a Z suffix
+ORJSON_OPTS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+ICE_GATHERING_TIMEOUT_S = 5.0
+
+# Encode outgoing H.264 on the GPU's NVENC engine instead of libx264 when available.
+# Set USE_NVENC=0 if NVENC contention with YOLO on the same GPU is measured.
+USE_NVENC = os.getenv("USE_NVENC", "1") == "1"
+NVENC_OPTIONS = {
+    "profile": "baseline",
+    "level": "3.1",
+    "preset": "p1",
+    "tune": "ull",
+    "zerolatency": "1",
+    "delay": "0",
+    "forced-idr": "1",  # aiortc's forced keyframes must be IDR for the browser to recover
+}
+
+# Skip YOLO when a frame's 16x16 thumbnail differs from the last inferred one by
+# less than this mean abs diff (0 = off); still re-run at least every DUP_MAX_SKIP frames
+DUP_FRAME_THRESHOLD = float(os.getenv("DUP_FRAME_THRESHOLD", "2.0"))
+DUP_MAX_SKIP = 15
+
+# From this many boxes up, outlines and label backgrounds are drawn per color in one call
+BATCH_DRAW_MIN_BOXES = 8
+
+
+# ==================== I420 Drawing ====================
+# Annotations are drawn straight onto the yuv420p frame the encoder consumes,
+# so the outgoing frame never needs a BGR -> YUV conversion.
+
+def i420_planes(yuv, w, h):
+    """Return (Y, U, V) views into a packed I420 array of a w x h frame."""
+    flat = yuv.reshape(-1)
+    y_size, c_size = w * h, (w // 2) * (h // 2)
+    return (
+        flat[:y_size].reshape(h, w),
+        flat[y_size:y_size + c_size].reshape(h // 2, w // 2),
+        flat[y_size + c_size:y_size + 2 * c_size].reshape(h // 2, w // 2),
+    )
+
+
+def bgr_to_yuv(color) -> tuple:
+    """Convert a BGR color to the (Y, U, V) values OpenCV's I420 conversion uses."""
+    yuv = cv2.cvtColor(np.full((2, 2, 3), color, np.uint8), cv2.COLOR_BGR2YUV_I420)
+    return int(yuv[0, 0]), int(yuv[2, 0]), int(yuv[2, 1])
+
+
+def draw_rect_i420(planes, pt1, pt2, color, thickness):
+    """cv2.rectangle on every plane; chroma planes are half resolution."""
+    for plane, value, s in zip(planes, color, (1, 2, 2)):
+        t = thickness if thickness < 0 else max(1, thickness // s)
+        cv2.rectangle(plane, (pt1[0] // s, pt1[1] // s), (pt2[0] // s, pt2[1] // s), value, t)
+
+
+def put_text_i420(planes, text, org, scale, color, thickness):
+    """cv2.putText on every plane; chroma planes are half resolution."""
+    for plane, value, s in zip(planes, color, (1, 2, 2)):
+        cv2.putText(
+            plane, text, (org[0] // s, org[1] // s),
+            cv2.FONT_HERSHEY_SIMPLEX, scale / s, value, max(1, thickness // s)
+        )
+
+
+def letterbox_into(img, canvas, dst):
+    """
+    Letterbox a BGR frame into canvas (size x size x 3 uint8, padded with Ultralytics'
+    gray 114) and write it to dst as normalised RGB CHW in one np.divide pass.
+    """
+    size = canvas.shape[0]
+    h, w = img.shape[:2]
+    r = min(size / h, size / w)
+    new_w, new_h = round(w * r), round(h * r)
+    top, left = (size - new_h) // 2, (size - new_w) // 2
+    canvas[:top] = 114
+    canvas[top + new_h:] = 114
+    canvas[:, :left] = 114
+    canvas[:, left + new_w:] = 114
+    cv2.resize(
+        img, (new_w, new_h), dst=canvas[top:top + new_h, left:left + new_w],
+        interpolation=cv2.INTER_LINEAR
+    )
+    # BGR -> RGB, HWC -> CHW and /255 fused into the write to the (pinned) input tensor
+    np.divide(canvas[..., ::-1], 255, out=dst.transpose(1, 2, 0), casting="unsafe")
+
+
+def rect_polygon(pt1, pt2):
+    """Corner points of an axis-aligned rectangle, for polylines/fillPoly."""
+    (x1, y1), (x2, y2) = pt1, pt2
+    return np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], np.int32)
+
+
+def draw_polys_i420(planes, polys, color, thickness):
+    """Outline (thickness > 0) or fill (thickness < 0) same-color polygons with one call per plane."""
+    for plane, value, s in zip(planes, color, (1, 2, 2)):
+        scaled = [p // s for p in polys]
+        if thickness < 0:
+            cv2.fillPoly(plane, scaled, value)
+        else:
+            cv2.polylines(plane, scaled, True, value, max(1, thickness // s))
+
+
+@lru_cache(maxsize=512)
+def label_size(label: str) -> tuple:
+    """Cached cv2.getTextSize for overlay labels: ((w, h), baseline)."""
+    return cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)
+
+
+def reuse_buffer(buf, shape):
+    """Return buf if it already has this shape, else a fresh uint8 buffer."""
+    if buf is None or buf.shape != shape:
+        return np.empty(shape, np.uint8)
+    return buf
+
+
+def frame_to_i420(frame, out):
+    """Copy a yuv420p VideoFrame's planes into a packed I420 buffer, dropping row padding."""
+    for plane, view in zip(frame.planes, i420_planes(out, frame.width, frame.height)):
+        rows, cols = view.shape
+        view[:] = np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)[:rows, :cols]
+    return out
+
+
+def resize_i420(yuv, w, h, new_w, new_h, out):
+    """Resize each I420 plane into a packed out buffer of the new size."""
+    for src, dst in zip(i420_planes(yuv, w, h), i420_planes(out, new_w, new_h)):
+        cv2.resize(src, (dst.shape[1], dst.shape[0]), dst=dst, interpolation=cv2.INTER_NEAREST)
+    return out
+
+
+COLOR_CRITICAL = bgr_to_yuv((0, 59, 255))   # Red
+COLOR_WARNING = bgr_to_yuv((0, 204, 255))   # Yellow
+COLOR_NORMAL = bgr_to_yuv((255, 123, 0))    # Blue
+COLOR_TEXT = bgr_to_yuv((255, 255, 255))    # White
+
+# Severity LUT indexed by bucket: 0 normal, 1 warning (>= 0.75), 2 critical (>= 0.90)
+SEVERITY_COLORS = np.array([COLOR_NORMAL, COLOR_WARNING, COLOR_CRITICAL], np.uint8)
+
+
+def severity_colors(confs) -> list:
+    """Map an array of confidences to I420 (Y, U, V) colors without per-box branching."""
+    buckets = np.where(confs >= 0.90, 2, np.where(confs >= 0.75, 1, 0))
+    return [tuple(c) for c in SEVERITY_COLORS[buckets].tolist()]
+
+
+# ==================== NVENC H.264 Encoder ====================
+
+_aiortc_create_encoder_context = aiortc_h264.create_encoder_context
+_nvenc_failed = False
+
+
+def create_encoder_context(codec_name, width, height, bitrate):
+    """
+    Drop-in for aiortc's create_encoder_context: aiortc asks for h264_omx first and
+    falls back to libx264, so h264_nvenc is tried in place of h264_omx.
+    """
+    global _nvenc_failed
+    if codec_name == "h264_omx" and not _nvenc_failed:
+        try:
+            codec = av.CodecContext.create("h264_nvenc", "w")
+            codec.width = width
+            codec.height = height
+            codec.bit_rate = bitrate
+            codec.pix_fmt = "yuv420p"
+            codec.framerate = fractions.Fraction(aiortc_h264.MAX_FRAME_RATE, 1)
+            codec.time_base = fractions.Fraction(1, aiortc_h264.MAX_FRAME_RATE)
+            codec.options = NVENC_OPTIONS
+            codec.open()
+            return codec, False
+        except Exception as e:
+            _nvenc_failed = True
+            logger.warning(f"h264_nvenc unavailable, using software H.264: {e}")
+    return _aiortc_create_encoder_context(codec_name, width, height, bitrate)
+
+
+def install_nvenc_encoder():
+    if USE_NVENC and torch.cuda.is_available() and "h264_nvenc" in av.codecs_available:
+        aiortc_h264.create_encoder_context = create_encoder_context
+        logger.info("🚀 H.264 encoding via NVENC (h264_nvenc)")
+
+
+# ==================== Worker Threads ====================
+
+class Worker:
+    """
+    Long-lived thread that runs submitted calls in order, so per-frame work
+    skips the default executor and stays on one thread with a warm CUDA context.
+    """
+
+    def __init__(self, name: str):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs) -> asyncio.Future:
+        """Run fn on the worker thread; await the returned future for its result."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put((loop, fut, fn, args, kwargs))
+        return fut
+
+    def stop(self):
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            loop, fut, fn, args, kwargs = item
+            try:
+                result, error = fn(*args, **kwargs), None
+            except Exception as e:
+                result, error = None, e
+            try:
+                loop.call_soon_threadsafe(_resolve_future, fut, result, error)
+            except RuntimeError:
+                pass  # event loop already closed
+
+
+def _resolve_future(fut, result, error):
+    if fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+
+# Every model call (WebRTC batches and /v1/detect) runs on this one thread
+inference_worker = Worker("yolo-inference")
+
+
+# ==================== Frame Batcher ====================
+
+class FrameBatcher:
+    """
+    Collects pending frames from all live tracks and runs them through
+    YOLO in a single predict call instead of one batch=1 pass per track.
+    """
+
+    def __init__(self, max_batch: int = INFER_BATCH, max_wait_ms: float = BATCH_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._task = None
+        self._tracks = 0
+        # Host input batch; on GPU it is pinned and, for PyTorch weights, uploaded
+        # on a dedicated CUDA stream instead of the default stream
+        self._input = None
+        self._stream = None
+        self._forward = None  # torch.compile'd model forward, see compile()
+        self._canvas = np.empty((INFER_IMGSZ, INFER_IMGSZ, 3), np.uint8)  # letterbox scratch
+
+    def attach(self):
+        """Register a live track so the batcher knows how many frames to wait for."""
+        self._tracks += 1
+
+    def detach(self):
+        self._tracks = max(0, self._tracks - 1)
+
+    async def submit(self, img, conf_threshold):
+        """Queue a BGR frame and wait for its (N, 6) x1, y1, x2, y2, conf, cls array (None on error)."""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((img, conf_threshold, fut))
+        return await fut
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _drain(self, batch):
+        while len(batch) < self.max_batch and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            self._drain(batch)
+            # Give the other live tracks a short window to join this batch
+            if len(batch) < min(self._tracks, self.max_batch):
+                await asyncio.sleep(self.max_wait)
+                self._drain(batch)
+
+            imgs = [img for img, _, _ in batch]
+            # Predict at the loosest threshold; each track filters to its own
+            conf = min(c for _, c, _ in batch)
+            try:
+                results = await inference_worker.submit(self._predict_sync, imgs, conf)
+            except Exception as e:
+                logger.error(f"Detection error: {e}")
+                results = [None] * len(batch)
+
+            for (_, _, fut), result in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(result)
+
+    def compile(self):
+        """Compile the PyTorch forward; CUDA graphs are recorded on the second batch of each size."""
+        self._forward = torch.compile(model.predictor.model.model, mode="reduce-overhead")
+
+    def _infer(self, backend, x):
+        if self._forward is not None:
+            try:
+                return self._forward(x)
+            except Exception as e:
+                logger.warning(f"torch.compile forward failed, using eager model: {e}")
+                self._forward = None
+        return backend(x)
+
+    def warmup(self):
+        """Run every batch size so cuDNN autotuning and CUDA graph capture happen before real frames."""
+        blank = np.zeros((INFER_IMGSZ, INFER_IMGSZ, 3), np.uint8)
+        # reduce-overhead only records the CUDA graph on the second call for a shape
+        runs = 2 if self._forward is not None else 1
+        for b in range(1, self.max_batch + 1):
+            for _ in range(runs):
+                self._predict_sync([blank] * b, 0.01)
+
+    def _setup_buffers(self, backend):
+        cuda = backend.device.type == "cuda"
+        dtype = torch.float16 if backend.fp16 else torch.float32
+        shape = (self.max_batch, 3, INFER_IMGSZ, INFER_IMGSZ)
+        self._input = torch.empty(shape, dtype=dtype, pin_memory=cuda)
+        # TensorRT's execute_v2 does not wait on a side stream, so engines upload
+        # on the current stream where the copy is ordered before inference
+        if cuda and not backend.engine:
+            self._stream = torch.cuda.Stream(device=backend.device)
+
+    def _predict_sync(self, imgs, conf):
+        """
+        Letterbox, normalise and call the AutoBackend directly, skipping the
+        Ultralytics predictor's per-call arg parsing and setup.
+        """
+        backend = model.predictor.model  # AutoBackend built (and fused) at startup
+        if self._input is None:
+            self._setup_buffers(backend)
+
+        # Reusing one buffer is safe: _postprocess ends in a blocking DtoH copy,
+        # so the previous upload has finished before the buffer is refilled
+        host = self._input[:len(imgs)]
+        host_np = host.numpy()
+        for i, img in enumerate(imgs):
+            letterbox_into(img, self._canvas, host_np[i])
+
+        with torch.inference_mode():
+            if self._stream is None:
+                x = host.to(backend.device, non_blocking=True)  # no-op on CPU
+                return self._postprocess(self._infer(backend, x), x.shape, imgs, conf)
+            with torch.cuda.stream(self._stream):
+                x = host.to(backend.device, non_blocking=True)
+                return self._postprocess(self._infer(backend, x), x.shape, imgs, conf)
+
+    @staticmethod
+    def _postprocess(preds, input_shape, imgs, conf):
+        dets = ops.non_max_suppression(preds, conf, 0.7, max_det=300)
+        for det, img in zip(dets, imgs):
+            det[:, :4] = ops.scale_boxes(input_shape[2:], det[:, :4], img.shape)
+        # One DtoH copy for the whole batch
+        out = torch.cat(dets).float().cpu().numpy()
+        return np.split(out, np.cumsum([len(d) for d in dets])[:-1])
+
+
+batcher = FrameBatcher()
+
 
 # ==================== Annotated Video Track ====================
 
@@ -98,93 +552,170 @@ class AnnotatedVideoTrack(VideoStreamTrack):
         self.config_holder = config_holder or {"conf_threshold": 0.70}
         self._frame_count = 0
         self._start_time = None
+        # Wall clock captured once; per-frame timestamps add a perf_counter delta
+        self._wall_base = datetime.utcnow()
+        self._perf_base = perf_counter()
+        # Per-track ByteTracker so track IDs never leak between peers
+        self._tracker = BYTETracker(args=TRACKER_CFG, frame_rate=30)
+        self._stopped = False
+        # Frame buffers reused across recv() calls while the resolution is unchanged
+        self._yuv = None
+        self._bgr = None
+        self._upbuf = None
+        self._dropped = 0  # Stale frames skipped under backpressure
+        # Scene-change check state: thumbnail/threshold of the last inferred frame
+        self._ref_small = None
+        self._ref_conf = None
+        self._skipped = 0
+        self._reused = 0  # Near-duplicate frames that reused the last tracks
+        self._prev_tracks = np.empty((0, 8), np.float32)
+        self._worker = Worker("track-postprocess")  # Tracking + drawing off the event loop
+        batcher.attach()
+
+    def stop(self):
+        if not self._stopped:
+            self._stopped = True
+            batcher.detach()
+            self._worker.stop()
+        super().stop()
     
     @property
     def conf_threshold(self):
         """Get current conf_threshold from config_holder for real-time updates"""
         return self.config_holder.get("conf_threshold", 0.70)
         
-    def get_severity_color(self, confidence: float) -> tuple:
-        """Get BGR color based on confidence level."""
-        if confidence >= 0.90:
-            return (0, 59, 255)   # Red (BGR) - Critical
-        elif confidence >= 0.75:
-            return (0, 204, 255)  # Yellow (BGR) - Warning
-        else:
-            return (255, 123, 0)  # Blue (BGR) - Normal
-    def _process_frame_sync(self, img, conf_threshold):
-        """Synchronous YOLO processing - runs in thread pool to avoid blocking."""
-        h, w = img.shape[:2]
+    def _latest_frame(self, frame):
+        """Skip frames that queued up in the relay while the previous one was processed."""
+        queue = getattr(self.source, "_queue", None)  # only buffered relay tracks have one
+        while queue is not None and not queue.empty():
+            newer = queue.get_nowait()
+            if newer is None:  # source ended; leave the marker for the next recv()
+                queue.put_nowait(None)
+                break
+            frame = newer
+            self._dropped += 1
+        return frame
+
+    def _is_near_duplicate(self, yuv, w, h, conf_threshold):
+        """Cheap scene-change check on a 16x16 thumbnail of the Y plane."""
+        if not DUP_FRAME_THRESHOLD:
+            return False
+        small = cv2.resize(
+            i420_planes(yuv, w, h)[0], (16, 16), interpolation=cv2.INTER_AREA
+        ).astype(np.int16)
+        if (
+            self._ref_small is not None
+            and conf_threshold == self._ref_conf
+            and self._skipped < DUP_MAX_SKIP
+            and np.abs(small - self._ref_small).mean() < DUP_FRAME_THRESHOLD
+        ):
+            self._skipped += 1
+            self._reused += 1
+            return True
+        self._ref_small = small
+        self._ref_conf = conf_threshold
+        self._skipped = 0
+        return False
+
+    def _process_frame_sync(self, yuv, w, h, result, conf_threshold, reuse=False):
+        """Track one frame's batched YOLO result and annotate the I420 frame - runs on the track worker."""
+        planes = i420_planes(yuv, w, h)
         detections_list = []
         
-        if model is not None and READY:
+        if result is not None or reuse:
             try:
-                # ByteTracker: persist=True maintains track IDs across frames
-                results = model.track(
-                    img,
-                    conf=conf_threshold,
-                    imgsz=640,
-                    verbose=False,
-                    device=DEVICE,
-                    half=True,         # FP16 inference - ~30% faster on GPU
-                    persist=True,      # Keep track IDs across frames (ByteTracker)
-                    tracker="bytetrack.yaml"  # Use ByteTracker (bundled in ultralytics)
-                )
-                
-                for box in results[0].boxes:
-                    x1, y1, x2, y2 = map(int, box.xyxy[0].tolist())
-                    cls_id = int(box.cls.item())
-                    cls_name = results[0].names.get(cls_id, str(cls_id))
-                    conf = float(box.conf.item())
-                    # ByteTracker assigns persistent track_id per object across frames
-                    track_id = int(box.id.item()) if box.id is not None else None
-                    
-                    color = self.get_severity_color(conf)
-                    cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
-                    
-                    label = f"#{track_id} {cls_name} {conf:.0%}" if track_id is not None else f"{cls_name} {conf:.0%}"
-                    (label_w, label_h), baseline = cv2.getTextSize(
-                        label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2
-                    )
-                    cv2.rectangle(
-                        img,
-                        (x1, y1 - label_h - baseline - 5),
-                        (x1 + label_w + 5, y1),
-                        color, -1
-                    )
-                    cv2.putText(
-                        img, label, (x1 + 2, y1 - 5),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2
-                    )
+                names = MODEL_NAMES
+                if reuse:
+                    # Near-duplicate frame: redraw the last tracks, ByteTracker untouched
+                    tracks = self._prev_tracks
+                else:
+                    # Batch result is already on the host; filter to this track's threshold
+                    det = Boxes(result, (h, w))
+                    keep = det.conf >= conf_threshold
+                    if NUM_CLASSES:
+                        keep &= det.cls < NUM_CLASSES  # padding classes
+                    det = det[keep]
+                    # ByteTracker rows: x1, y1, x2, y2, track_id, conf, cls, idx
+                    tracks = self._tracker.update(det) if len(det) else np.empty((0, 8), np.float32)
+                    tracks = self._prev_tracks = tracks.reshape(-1, 8)
+                xyxy = tracks[:, :4].astype(np.int32)
+                xywh = xyxy.copy()
+                xywh[:, 2:] -= xywh[:, :2]
+                xywh_norm = (xywh / np.array([w, h, w, h], dtype=np.float32)).tolist()
+                confs = tracks[:, 5].tolist()
+                colors = severity_colors(tracks[:, 5])
+                cls_ids = tracks[:, 6].astype(np.int32).tolist()
+                # ByteTracker assigns persistent track_id per object across frames
+                track_ids = tracks[:, 4].astype(np.int32).tolist()
+
+                batch_draw = len(tracks) >= BATCH_DRAW_MIN_BOXES
+                outlines, backgrounds, labels = {}, {}, []
+
+                for (x1, y1, x2, y2), bbox, bbox_norm, conf, cls_id, track_id, color in zip(
+                    xyxy.tolist(), xywh.tolist(), xywh_norm, confs, cls_ids, track_ids, colors
+                ):
+                    cls_name = names.get(cls_id, str(cls_id))
+                    label = f"#{track_id} {cls_name} {conf:.0%}"
+                    (label_w, label_h), baseline = label_size(label)
+                    label_bg = ((x1, y1 - label_h - baseline - 5), (x1 + label_w + 5, y1))
+
+                    if batch_draw:
+                        outlines.setdefault(color, []).append(rect_polygon((x1, y1), (x2, y2)))
+                        backgrounds.setdefault(color, []).append(rect_polygon(*label_bg))
+                        labels.append((label, (x1 + 2, y1 - 5)))
+                    else:
+                        draw_rect_i420(planes, (x1, y1), (x2, y2), color, 2)
+                        draw_rect_i420(planes, *label_bg, color, -1)
+                        put_text_i420(planes, label, (x1 + 2, y1 - 5), 0.6, COLOR_TEXT, 2)
                     
                     detections_list.append({
                         "cls": cls_name,
                         "conf": conf,
-                        "track_id": str(track_id) if track_id is not None else None,
-                        "bbox_xywh": [x1, y1, x2 - x1, y2 - y1],
-                        "bbox_xywh_norm": [x1/w, y1/h, (x2-x1)/w, (y2-y1)/h],
+                        "track_id": str(track_id),
+                        "bbox_xywh": bbox,
+                        "bbox_xywh_norm": bbox_norm,
                     })
+
+                for color, polys in outlines.items():
+                    draw_polys_i420(planes, polys, color, 2)
+                for color, polys in backgrounds.items():
+                    draw_polys_i420(planes, polys, color, -1)
+                for label, org in labels:
+                    put_text_i420(planes, label, org, 0.6, COLOR_TEXT, 2)
             except Exception as e:
                 logger.error(f"Detection error: {e}")
         
-        return img, detections_list, w, h
+        return detections_list
     
     async def recv(self):
         """Receive frame, process in thread, annotate, and return."""
         t0 = perf_counter()
-        frame = await self.source.recv()
+        frame = self._latest_frame(await self.source.recv())
         t1 = perf_counter()
         
         if self._start_time is None:
             self._start_time = perf_counter()
         
-        # Convert frame to numpy array (BGR for OpenCV)
-        img = frame.to_ndarray(format="bgr24")
+        # Keep the frame in yuv420p (the encoder's format); only YOLO gets a BGR copy
+        if frame.format.name != "yuv420p" or frame.width % 2 or frame.height % 2:
+            frame = frame.reformat(width=frame.width & ~1, height=frame.height & ~1, format="yuv420p")
+        w, h = frame.width, frame.height
+        self._yuv = reuse_buffer(self._yuv, (h * 3 // 2, w))
+        self._bgr = reuse_buffer(self._bgr, (h, w, 3))
+        yuv = frame_to_i420(frame, self._yuv)
+        conf_threshold = self.conf_threshold
+        # Near-duplicate frames reuse the last tracks and skip BGR conversion + YOLO
+        reuse = self._is_near_duplicate(yuv, w, h, conf_threshold)
+        if not reuse:
+            img = cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR_I420, dst=self._bgr)
         t2 = perf_counter()
         
-        # Run YOLO in thread pool to avoid blocking event loop
-        img, detections_list, w, h = await asyncio.to_thread(
-            self._process_frame_sync, img, self.conf_threshold
+        # Batched YOLO across tracks, then tracking + drawing on this track's worker
+        result = None
+        if not reuse and model is not None and READY:
+            result = await batcher.submit(img, conf_threshold)
+        detections_list = await self._worker.submit(
+            self._process_frame_sync, yuv, w, h, result, conf_threshold, reuse
         )
         t3 = perf_counter()
         
@@ -200,29 +731,30 @@ class AnnotatedVideoTrack(VideoStreamTrack):
             try:
                 if channel and channel.readyState == "open":
                     metadata = {
-                        "ts": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
+                        "ts": self._wall_base + timedelta(seconds=perf_counter() - self._perf_base),
                         "fps": fps,
                         "img_w": w,
                         "img_h": h,
                         "frame_id": self._frame_count,
                         "detections": detections_list
                     }
-                    channel.send(json.dumps(metadata))
+                    # Sent as text: the browser JSON.parse()s the message
+                    channel.send(orjson.dumps(metadata, option=ORJSON_OPTS).decode())
             except Exception as e:
                 logger.warning(f"DataChannel send error: {e}")
         
-        # Ensure minimum resolution of 720p for better quality
-        MIN_HEIGHT = 720
-        if h < MIN_HEIGHT:
-            scale = MIN_HEIGHT / h
-            new_w = int(w * scale)
-            new_h = MIN_HEIGHT
-            img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+        # Optional size matching for sinks that need a minimum resolution
+        if UPSCALE_MIN_HEIGHT and h < UPSCALE_MIN_HEIGHT:
+            scale = UPSCALE_MIN_HEIGHT / h
+            new_w = int(w * scale) & ~1
+            new_h = UPSCALE_MIN_HEIGHT & ~1
+            self._upbuf = reuse_buffer(self._upbuf, (new_h * 3 // 2, new_w))
+            yuv = resize_i420(yuv, w, h, new_w, new_h, self._upbuf)
             if self._frame_count <= 1:
                 logger.info(f"Upscaled frame from {w}x{h} to {new_w}x{new_h}")
         
         # Convert back to VideoFrame with proper pts
-        new_frame = VideoFrame.from_ndarray(img, format="bgr24")
+        new_frame = VideoFrame.from_ndarray(yuv, format="yuv420p")
         new_frame.pts = frame.pts
         new_frame.time_base = frame.time_base
         t4 = perf_counter()
@@ -236,36 +768,75 @@ class AnnotatedVideoTrack(VideoStreamTrack):
                 f"yolo: {(t3-t2)*1000:.1f}ms | "
                 f"post: {(t4-t3)*1000:.1f}ms | "
                 f"total: {(t4-t0)*1000:.1f}ms | "
-                f"= {1/(t4-t0):.1f} FPS"
+                f"= {1/(t4-t0):.1f} FPS | "
+                f"dropped: {self._dropped} | "
+                f"reused: {self._reused}"
             )
         
         return new_frame
 
 # ==================== Startup/Shutdown Events ====================
 
-@app.on_event("startup")
-def load_model_startup():
-    global model, READY
+def load_model_sync():
+    """Load the model (exporting the engine if needed) and warm it up at the production shapes."""
+    global model, READY, MODEL_NAME, MODEL_NAMES, USING_ENGINE
     try:
-        model = YOLO(MODEL_PATH)
-        _ = model.predict(
-            np.zeros((64, 64, 3), dtype=np.uint8),
-            imgsz=64, conf=0.01, verbose=False, device=DEVICE
-        )
+        try:
+            weights = resolve_model_path()
+        except Exception as e:
+            logger.warning(f"TensorRT export failed, falling back to PyTorch weights: {e}")
+            weights = MODEL_PATH
+        model = YOLO(weights, task="detect")
+        MODEL_NAME = weights.name
+        USING_ENGINE = weights.suffix == ".engine"
+        if not USING_ENGINE:
+            model.fuse()  # Conv+BN folded once instead of inside the first predict
+        # Warm every imgsz /v1/detect serves (the engine only has its build shape) so cuDNN
+        # benchmarks the real shapes. Also builds the AutoBackend the batcher reuses;
+        # half is fixed here: FP16 for .pt on GPU only, CPU stays FP32
+        half = torch.cuda.is_available() and not USING_ENGINE
+        for sz in (INFER_IMGSZ,) if USING_ENGINE else (INFER_IMGSZ, DETECT_IMGSZ):
+            model.predict(
+                np.zeros((sz, sz, 3), dtype=np.uint8),
+                imgsz=sz, conf=0.01, verbose=False, device=DEVICE, half=half
+            )
+        MODEL_NAMES = model.names
+        if (
+            USE_TORCH_COMPILE
+            and not USING_ENGINE
+            and torch.cuda.is_available()
+            and torch.cuda.get_device_capability(0) >= COMPILE_MIN_CAPABILITY
+        ):
+            batcher.compile()
+            logger.info("torch.compile(mode='reduce-overhead') enabled for streaming inference")
+        batcher.warmup()
         READY = True
-        logger.info(f"Model loaded on device={DEVICE}, CUDA={torch.cuda.is_available()}")
+        logger.info(f"Model {MODEL_NAME} loaded on device={DEVICE}, CUDA={torch.cuda.is_available()}")
         if torch.cuda.is_available():
             logger.info(f"GPU: {torch.cuda.get_device_name(0)}")
     except Exception as e:
         READY = False
         logger.error(f"Failed to load model: {e}")
 
+@app.on_event("startup")
+async def load_model_startup():
+    # Half the cores for OpenCV's row-parallel resize/convert; the rest stay with torch
+    cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
+    parallel = [l.strip() for l in cv2.getBuildInformation().splitlines() if "Parallel framework" in l]
+    logger.info(f"OpenCV threads={cv2.getNumThreads()} | {parallel[0] if parallel else 'Parallel framework: unknown'}")
+    install_nvenc_encoder()
+    # Load + warm up on the inference thread in the background: /health answers
+    # right away and /ready turns true once warmup is done
+    inference_worker.submit(load_model_sync)
+
 @app.on_event("shutdown")
 async def shutdown_event():
     # Close all peer connections
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
     pcs.clear()
+    await batcher.stop()
+    inference_worker.stop()
 
 # ==================== Health Endpoints ====================
 
@@ -283,7 +854,7 @@ def ready():
 async def detect(
     file: UploadFile = File(...),
     conf: float = Query(0.70, ge=0.0, le=1.0),
-    imgsz: int = Query(832, ge=64, le=2048),
+    imgsz: int = Query(DETECT_IMGSZ, ge=64, le=2048),
 ):
     if not READY or model is None:
         raise HTTPException(status_code=503, detail="Model not ready")
@@ -294,9 +865,15 @@ async def detect(
     if img is None:
         raise HTTPException(status_code=400, detail="Invalid image file")
 
+    # The TensorRT engine is built for a fixed input shape
+    if USING_ENGINE:
+        imgsz = INFER_IMGSZ
+
     t0 = perf_counter()
     try:
-        res = model.predict(img, conf=conf, imgsz=imgsz, verbose=False, device=DEVICE)
+        res = await inference_worker.submit(
+            model.predict, img, conf=conf, imgsz=imgsz, verbose=False, device=DEVICE
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"inference error: {e}")
     r = res[0]
@@ -305,16 +882,22 @@ async def detect(
     h, w = img.shape[:2]
     if getattr(r, "boxes", None) is not None and len(r.boxes) > 0:
         names = r.names or {}
-        for b in r.boxes:
-            conf_v = float(b.conf.item())
-            cls_id = int(b.cls.item())
-            x1, y1, x2, y2 = [float(v) for v in b.xyxy[0].tolist()]
-            detections.append(Detection(
-                cls=names.get(cls_id, str(cls_id)),
+        # Rows: x1, y1, x2, y2, conf, cls
+        data = r.boxes.data.cpu().numpy()
+        if NUM_CLASSES:
+            data = data[data[:, 5] < NUM_CLASSES]  # padding classes
+        xywh = data[:, :4].astype(np.float64)
+        xywh[:, 2:] -= xywh[:, :2]
+        xywh_norm = xywh / np.array([w, h, w, h])
+        detections = [
+            Detection(
+                cls=names.get(int(cls_id), str(int(cls_id))),
                 conf=conf_v,
-                bbox_xywh=[x1, y1, x2 - x1, y2 - y1],
-                bbox_xywh_norm=[x1 / w, y1 / h, (x2 - x1) / w, (y2 - y1) / h]
-            ))
+                bbox_xywh=row[0:4],
+                bbox_xywh_norm=row[4:8],
+            )
+            for *row, conf_v, cls_id in np.column_stack((xywh, xywh_norm, data[:, 4:6])).tolist()
+        ]
 
     dt = perf_counter() - t0
     fps = (1.0 / dt) if dt > 0 else 0.0
@@ -394,6 +977,14 @@ async def webrtc_offer(request: Request):
             await pc.close()
             pcs.discard(pc)
     
+    # Resolved by the state-change event instead of polling iceGatheringState
+    ice_gathering_done = asyncio.Event()
+
+    @pc.on("icegatheringstatechange")
+    def on_icegatheringstatechange():
+        if pc.iceGatheringState == "complete":
+            ice_gathering_done.set()
+    
     @pc.on("track")
     def on_track(track):
         logger.info(f"Received track: {track.kind}")
@@ -429,8 +1020,11 @@ async def webrtc_offer(request: Request):
     await pc.setLocalDescription(answer)
     
     # Wait for ICE gathering to complete
-    while pc.iceGatheringState != "complete":
-        await asyncio.sleep(0.1)
+    if pc.iceGatheringState != "complete":
+        try:
+            await asyncio.wait_for(ice_gathering_done.wait(), timeout=ICE_GATHERING_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            logger.warning("ICE gathering timed out; answering with the candidates gathered so far")
     
     return JSONResponse({
         "sdp": pc.localDescription.sdp,